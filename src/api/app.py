@@ -7,7 +7,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
 
 from api.routers import model, chat, embeddings
-from api.setting import API_ROUTE_PREFIX, TITLE, DESCRIPTION, SUMMARY, VERSION
+from api.setting import API_ROUTE_PREFIX, TITLE, DESCRIPTION, SUMMARY, VERSION, DEBUG
 
 config = {
     "title": TITLE,
@@ -20,6 +20,8 @@ logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
+# Debug logs of the proxy itself are only emitted when DEBUG is enabled.
+logging.getLogger("api").setLevel(logging.DEBUG if DEBUG else logging.INFO)
 app = FastAPI(**config)
 
 app.add_middleware(
@@ -2,16 +2,22 @@ import uuid
 from abc import ABC, abstractmethod
 from typing import AsyncIterable
 
+import orjson
+
 from api.schema import (
     # Chat
     ChatResponse,
     ChatRequest,
-    ChatStreamResponse,
     # Embeddings
     EmbeddingsRequest,
     EmbeddingsResponse,
 )
 
+# Server-sent events framing of the stream chunks.
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+SSE_DONE = b"data: [DONE]\n\n"
+
 
 class BaseChatModel(ABC):
     """Represent a basic chat model
@@ -35,11 +41,11 @@ class BaseChatModel(ABC):
 
     @staticmethod
     def stream_response_to_bytes(
-            response: ChatStreamResponse | None = None
+            response: dict | None = None
     ) -> bytes:
         if response:
-            return "data: {}\n\n".format(response.model_dump_json()).encode("utf-8")
-        return "data: [DONE]\n\n".encode("utf-8")
+            return SSE_PREFIX + orjson.dumps(response) + SSE_SUFFIX
+        return SSE_DONE
 
 
 class BaseEmbeddingsModel(ABC):
@@ -1,15 +1,22 @@
-import base64
+import functools
+import http.cookiejar
 import json
 import logging
 import re
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from typing import AsyncIterable, Iterable, Literal, Dict, Any
 
 import boto3
 import numpy as np
+import orjson
+import pybase64
 import requests
 import tiktoken
 from fastapi import HTTPException
+from requests.adapters import HTTPAdapter
 
 
 from api.models.base import BaseChatModel, BaseEmbeddingsModel
@@ -20,8 +27,6 @@ from api.schema import (
     Choice,
     ChatResponseMessage,
     Usage,
-    ChatStreamResponse,
-    ChoiceDelta,
     ImageContent,
     TextContent,
     ResponseFunction,
@@ -32,7 +37,7 @@ from api.schema import (
     EmbeddingsUsage,
     Embedding,
 )
-from api.setting import DEBUG, AWS_REGION
+from api.setting import AWS_REGION, STREAM_COALESCE_CHUNKS
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +46,32 @@ bedrock_runtime = boto3.client(
     region_name=AWS_REGION,
 )
 
+# All models take and return JSON, shared by every invoke model call.
+INVOKE_MODEL_CONTENT_TYPES = {
+    "accept": "application/json",
+    "contentType": "application/json",
+}
+
+# Downloaded images, keyed by url, as (expiry time, base64 data, content type).
+# Clients resend the same image url with every turn of a conversation, so images
+# are cached briefly. The cache is shared by all clients: entries expire after
+# IMAGE_CACHE_TTL seconds so that changed content at the same url is picked up,
+# and only images up to IMAGE_CACHE_MAX_IMAGE_SIZE base64 characters are kept,
+# which bounds the cache to IMAGE_CACHE_MAX_IMAGES * IMAGE_CACHE_MAX_IMAGE_SIZE.
+IMAGE_CACHE_TTL = 300
+IMAGE_CACHE_MAX_IMAGES = 16
+IMAGE_CACHE_MAX_IMAGE_SIZE = 1024 * 1024
+image_cache: OrderedDict[str, tuple[float, str, str]] = OrderedDict()
+image_cache_lock = threading.Lock()
+
+# Shared session so that image downloads reuse pooled keep-alive connections.
+# It is shared by all clients, so cookies are never stored to avoid sending one
+# caller's cookies along with another caller's downloads.
+http_session = requests.Session()
+http_session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+http_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+http_session.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
 SUPPORTED_BEDROCK_MODELS = {
     "anthropic.claude-instant-v1": "Claude Instant",
     "anthropic.claude-v2:1": "Claude",
@@ -67,14 +98,47 @@ SUPPORTED_BEDROCK_EMBEDDING_MODELS = {
     # "amazon.titan-embed-image-v1": "Titan Multimodal Embeddings G1"
 }
 
-ENCODER = tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=1)
+def get_encoder() -> tiktoken.Encoding:
+    """Load the tiktoken encoding on first use.
+
+    It is only needed to decode token inputs for embeddings,
+    so this keeps the cost of loading it out of the cold start.
+    """
+    return tiktoken.get_encoding("cl100k_base")
+
+
+# Matches the prefix of an already base64 encoded image, e.g. "data:image/png;base64,"
+DATA_URL_PATTERN = re.compile(r"^data:(image/[a-z]*);base64,\s*")
+
+
+class LazyJson:
+    """Defer the JSON dump of a pydantic model until a log record is emitted."""
+
+    __slots__ = ("model",)
+
+    def __init__(self, model):
+        self.model = model
+
+    def __str__(self) -> str:
+        return self.model.model_dump_json()
+
+
+class LazyEscapedText:
+    """Defer escaping the line breaks of a text until a log record is emitted."""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __str__(self) -> str:
+        return self.text.replace("\n", "\\n")
 
 
 # https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters.html
 class BedrockModel(BaseChatModel, ABC):
-    accept = "application/json"
-    content_type = "application/json"
-
     # Default field name to get the response message
     text_field_name = "text"
 
@@ -82,24 +146,19 @@ class BedrockModel(BaseChatModel, ABC):
     finish_reason_field_name = "finish_reason"
 
     @abstractmethod
-    def compose_request_body(self, chat_request: ChatRequest) -> str:
+    def compose_request_body(self, chat_request: ChatRequest) -> bytes:
         """Since the request body to Bedrock varies,
         each model should implement this to compose the request body.
 
         :param chat_request:
-        :return: request body as a string
+        :return: request body as JSON encoded bytes
         """
         raise NotImplementedError()
 
     def chat(self, chat_request: ChatRequest) -> ChatResponse:
         """Default implementation for Chat API."""
-        if DEBUG:
-            logger.info("Raw request: " + chat_request.model_dump_json())
+        logger.debug("Raw request: %s", LazyJson(chat_request))
         request_body = self.compose_request_body(chat_request)
-
-        if DEBUG:
-            logger.info("Bedrock request: " + request_body)
-
         response = self.invoke_model(
             request_body=request_body,
             model_id=chat_request.model,
@@ -109,8 +168,7 @@ class BedrockModel(BaseChatModel, ABC):
 
     def chat_stream(self, chat_request: ChatRequest) -> AsyncIterable[bytes]:
         """Default implementation for Chat Stream API"""
-        if DEBUG:
-            logger.info("Raw request: " + chat_request.model_dump_json())
+        logger.debug("Raw request: %s", LazyJson(chat_request))
         request_body = self.compose_request_body(chat_request)
         response = self.invoke_model(
             request_body=request_body,
@@ -122,7 +180,7 @@ class BedrockModel(BaseChatModel, ABC):
         for stream_response in self.parse_stream_response(
             chat_request, response, message_id
         ):
-            if stream_response.choices:
+            if stream_response["choices"]:
                 yield self.stream_response_to_bytes(stream_response)
             elif (
                 chat_request.stream_options
@@ -161,9 +219,8 @@ class BedrockModel(BaseChatModel, ABC):
     def parse_response(
         self, chat_request: ChatRequest, service_response: dict, message_id: str
     ) -> ChatResponse:
-        response_body = json.loads(service_response.get("body").read())
-        if DEBUG:
-            logger.info("Bedrock response body: " + str(response_body))
+        response_body = orjson.loads(service_response["body"].read())
+        logger.debug("Bedrock response body: %s", response_body)
 
         input_tokens, output_tokens = self.get_message_usage(response_body)
         return self.create_response(
@@ -177,14 +234,11 @@ class BedrockModel(BaseChatModel, ABC):
 
     def parse_stream_response(
         self, chat_request: ChatRequest, service_response: dict, message_id: str
-    ) -> Iterable[ChatStreamResponse]:
+    ) -> Iterable[dict]:
 
-        chunk_id = 0
-        for event in service_response.get("body"):
-            if DEBUG:
-                logger.info("Bedrock response chunk: " + str(event))
-            chunk = json.loads(event["chunk"]["bytes"])
-            chunk_id += 1
+        for event in service_response["body"]:
+            logger.debug("Bedrock response chunk: %s", event)
+            chunk = orjson.loads(event["chunk"]["bytes"])
 
             response = self.create_response_stream(
                 model=chat_request.model,
@@ -206,23 +260,21 @@ class BedrockModel(BaseChatModel, ABC):
                     ],
                 )
 
-    def invoke_model(self, request_body: str, model_id: str, with_stream: bool = False):
-        if DEBUG:
-            logger.info("Invoke Bedrock Model: " + model_id)
-            logger.info("Bedrock request body: " + request_body)
+    def invoke_model(self, request_body: bytes, model_id: str, with_stream: bool = False):
+        logger.debug("Invoke Bedrock Model: %s", model_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Bedrock request body: %s", request_body.decode())
         try:
             if with_stream:
                 return bedrock_runtime.invoke_model_with_response_stream(
                     body=request_body,
                     modelId=model_id,
-                    accept=self.accept,
-                    contentType=self.content_type,
+                    **INVOKE_MODEL_CONTENT_TYPES,
                 )
             return bedrock_runtime.invoke_model(
                 body=request_body,
                 modelId=model_id,
-                accept=self.accept,
-                contentType=self.content_type,
+                **INVOKE_MODEL_CONTENT_TYPES,
             )
         except bedrock_runtime.exceptions.ValidationException as e:
             logger.error("Validation Error: " + str(e))
@@ -236,29 +288,36 @@ class BedrockModel(BaseChatModel, ABC):
         """Merge the request messages with the same role as previous message"""
         merged_messages = []
         prev_role = None
-        merged_content = ""
+        merged_parts = []
+        # Length of the merged content so far, i.e. "\n".join(merged_parts)
+        merged_length = 0
 
         for message in messages:
             role = message["role"]
             content = message["content"]
-            if role != prev_role or isinstance(content, list):
+            content_type = type(content)
+            if role != prev_role or content_type is list:
                 if prev_role:
                     merged_messages.append(
-                        {"role": prev_role, "content": merged_content}
+                        {"role": prev_role, "content": "\n".join(merged_parts)}
                     )
-                if isinstance(content, str):
-                    merged_content = content
+                if content_type is str:
+                    merged_parts = [content]
+                    merged_length = len(content)
                     prev_role = role
                 else:
                     merged_messages.append({"role": role, "content": content})
                     prev_role = None
-                    merged_content = ""
+                    merged_parts = []
+                    merged_length = 0
             else:
-                if content == merged_content:
+                if len(content) == merged_length and content == "\n".join(merged_parts):
                     # ignore duplicates
                     continue
-                merged_content += "\n" + content
+                merged_parts.append(content)
+                merged_length += 1 + len(content)
 
+        merged_content = "\n".join(merged_parts)
         if merged_content:
             merged_messages.append({"role": prev_role, "content": merged_content})
         return merged_messages
@@ -293,8 +352,7 @@ class BedrockModel(BaseChatModel, ABC):
                 total_tokens=input_tokens + output_tokens,
             ),
         )
-        if DEBUG:
-            logger.info("Proxy response :" + response.model_dump_json())
+        logger.debug("Proxy response: %s", LazyJson(response))
         return response
 
     @staticmethod
@@ -306,36 +364,43 @@ class BedrockModel(BaseChatModel, ABC):
         tools: list[ToolCall] | None = None,
         input_tokens: int = 0,
         output_tokens: int = 0,
-    ) -> ChatStreamResponse:
+    ) -> dict:
+        """Create a stream chunk following the ChatStreamResponse schema.
+
+        A plain dict is used as this runs once per streamed token,
+        which saves validating and dumping a pydantic model each time.
+        """
+        response = {
+            "id": message_id,
+            "created": int(time.time()),
+            "model": model,
+            "system_fingerprint": "fp",
+            "object": "chat.completion.chunk",
+        }
         if chunk_message or finish_reason or tools:
-            response = ChatStreamResponse(
-                id=message_id,
-                model=model,
-                choices=[
-                    ChoiceDelta(
-                        index=0,
-                        delta=ChatResponseMessage(
-                            role="assistant",
-                            tool_calls=tools,
-                            content=chunk_message,
+            response["choices"] = [
+                {
+                    "index": 0,
+                    "finish_reason": finish_reason,
+                    "logprobs": None,
+                    "delta": {
+                        "role": "assistant",
+                        "content": chunk_message,
+                        "tool_calls": (
+                            [tool.model_dump() for tool in tools] if tools else None
                         ),
-                        finish_reason=finish_reason,
-                    )
-                ],
-            )
+                    },
+                }
+            ]
+            response["usage"] = None
         else:
-            response = ChatStreamResponse(
-                id=message_id,
-                model=model,
-                choices=[],
-                usage=Usage(
-                    prompt_tokens=input_tokens,
-                    completion_tokens=output_tokens,
-                    total_tokens=input_tokens + output_tokens,
-                ),
-            )
-        if DEBUG:
-            logger.info("Proxy response :" + response.model_dump_json())
+            response["choices"] = []
+            response["usage"] = {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            }
+        logger.debug("Proxy response: %s", response)
         return response
 
 
@@ -351,74 +416,76 @@ Please think if you need to use a tool or not for user's question, you must:
    {{"name": $TOOL_NAME, "arguments": {{"$PARAMETER_NAME": "$PARAMETER_VALUE", ...}}}}
 3. If no tools is needed, respond with normal text."""
 
-    def compose_request_body(self, chat_request: ChatRequest) -> str:
+    def compose_request_body(self, chat_request: ChatRequest) -> bytes:
         args = {
             "anthropic_version": self.anthropic_version,
             "max_tokens": chat_request.max_tokens,
             "top_p": chat_request.top_p,
             "temperature": chat_request.temperature,
         }
-        system_prompt = ""
+        system_parts = []
         converted_messages = []
         for message in chat_request.messages:
-            if message.role == "system":
-                assert isinstance(message.content, str)
-                system_prompt += message.content + "\n"
-            elif message.role == "user" and not isinstance(message.content, str):
+            role = message.role
+            content = message.content
+            if role == "system":
+                assert isinstance(content, str)
+                system_parts.append(content)
+            elif role == "user" and not isinstance(content, str):
                 converted_messages.append(
                     {
-                        "role": message.role,
-                        "content": self._parse_content_parts(message.content),
+                        "role": role,
+                        "content": self._parse_content_parts(content),
                     }
                 )
-            elif message.role == "assistant" and not message.content:
+            elif role == "assistant" and not content:
                 # if content is empty
                 # create the content using the tool call info.
+                tool_call = message.tool_calls[0]
                 tool_content = "[Tool use for `{}` with id `{}` with the following `input`]\n{}".format(
-                    message.tool_calls[0].function.name,
-                    message.tool_calls[0].id,
-                    message.tool_calls[0].function.arguments,
+                    tool_call.function.name,
+                    tool_call.id,
+                    tool_call.function.arguments,
                 )
                 converted_messages.append(
-                    {"role": message.role, "content": tool_content}
+                    {"role": role, "content": tool_content}
                 )
-            elif message.role == "tool":
+            elif role == "tool":
                 # Since bedrock does not support tool role
                 # Convert the tool message to a user message.
                 converted_messages.append(
                     {
                         "role": "user",
                         "content": "[Tool result with matching id `{}` of `{}`] ".format(
-                            message.tool_call_id, message.content
+                            message.tool_call_id, content
                         ),
                     }
                 )
             else:
                 converted_messages.append(
-                    {"role": message.role, "content": message.content}
+                    {"role": role, "content": content}
                 )
 
         if chat_request.tools:
             tools_str = json.dumps(
                 [tool.function.model_dump() for tool in chat_request.tools]
             )
-            system_prompt += self.tool_prompt.format(tools=tools_str)
+            system_parts.append(self.tool_prompt.format(tools=tools_str))
             converted_messages.append({"role": "assistant", "content": "<tool>"})
             args["stop_sequences"] = ["</function>"]
         args["messages"] = self.merge_message(converted_messages)
+        system_prompt = "\n".join(system_parts)
         if system_prompt:
-            if DEBUG:
-                logger.info("System Prompt: " + system_prompt)
+            logger.debug("System Prompt: %s", system_prompt)
             args["system"] = system_prompt
 
-        return json.dumps(args)
+        return orjson.dumps(args)
 
     def parse_response(
         self, chat_request: ChatRequest, service_response: dict, message_id: str
     ) -> ChatResponse:
-        response_body = json.loads(service_response.get("body").read())
-        if DEBUG:
-            logger.info("Bedrock response body: " + str(response_body))
+        response_body = orjson.loads(service_response["body"].read())
+        logger.debug("Bedrock response body: %s", response_body)
         message = response_body["content"][0]["text"]
         finish_reason = response_body["stop_reason"]
         tools = None
@@ -441,19 +508,24 @@ Please think if you need to use a tool or not for user's question, you must:
 
     def parse_stream_response(
         self, chat_request: ChatRequest, service_response: dict, message_id: str
-    ) -> Iterable[ChatStreamResponse]:
-
-        chunk_id = 0
-        tool_message = ""
-        first_token = True
+    ) -> Iterable[dict]:
+
+        # With tools, the first token tells if a tool call follows:
+        # "detect": waiting for the first token, "Y" means a tool call.
+        # "tool": buffering the whole tool call message.
+        # "skip": dropping the rest of the "N</tool>" prefix.
+        # "text": streaming the text answer.
+        state = "detect" if chat_request.tools else "text"
+        tool_parts = []
+        # Text tokens held back to be sent together, see STREAM_COALESCE_CHUNKS.
+        text_parts = []
         index = 0
-        for event in service_response.get("body"):
-            if DEBUG:
-                logger.info("Bedrock response chunk: " + str(event))
-            chunk = json.loads(event["chunk"]["bytes"])
-            chunk_id += 1
+        for event in service_response["body"]:
+            logger.debug("Bedrock response chunk: %s", event)
+            chunk = orjson.loads(event["chunk"]["bytes"])
+            chunk_type = chunk["type"]
 
-            if chunk["type"] == "message_stop":
+            if chunk_type == "message_stop":
                 # Get the usage for streaming response anyway.
                 if "amazon-bedrock-invocationMetrics" in chunk:
                     yield self.create_response_stream(
@@ -468,13 +540,16 @@ Please think if you need to use a tool or not for user's question, you must:
                     )
                 break
 
-            elif chunk["type"] == "message_delta":
+            elif chunk_type == "message_delta":
                 chunk_message = ""
                 finish_reason = chunk["delta"]["stop_reason"]
 
+                # Flush the held back text before finishing.
+                yield from self._flush_text(chat_request, message_id, text_parts)
+
                 # Send tool message first if any.
-                if chat_request.tools and tool_message:
-                    tools = self._parse_tool_message(tool_message)
+                if state == "tool":
+                    tools = self._parse_tool_message("".join(tool_parts))
                     finish_reason = "tool_calls"
                     response = self.create_response_stream(
                         model=chat_request.model,
@@ -483,26 +558,31 @@ Please think if you need to use a tool or not for user's question, you must:
                     )
                     yield response
 
-            elif chunk["type"] == "content_block_delta":
+            elif chunk_type == "content_block_delta":
                 chunk_message = chunk["delta"]["text"]
                 finish_reason = None
-                if chat_request.tools:
+                if state == "tool":
+                    # Buffer all chunk message
+                    # in order to extract tool call info
+                    tool_parts.append(chunk_message)
+                    continue
+                if state == "detect":
                     # Check first token
-                    if not tool_message and chunk_message == "Y":
-                        tool_message = "Y"
-                        continue
-                    if tool_message:
-                        # Buffer all chunk message
-                        # in order to extract tool call info
-                        tool_message += chunk_message
+                    if chunk_message == "Y":
+                        state = "tool"
+                        tool_parts.append(chunk_message)
                         continue
+                    state = "skip"
+                if state == "skip":
                     if index < 3:
                         # Ignore the N</tool>, which is 3 tokens
                         index += 1
                         continue
-                    if first_token:
-                        chunk_message = chunk_message.lstrip("\n")
-                        first_token = False
+                    state = "text"
+                    chunk_message = chunk_message.lstrip("\n")
+                chunk_message = self._hold_back_text(text_parts, chunk_message)
+                if chunk_message is None:
+                    continue
             else:
                 continue
             response = self.create_response_stream(
@@ -514,14 +594,44 @@ Please think if you need to use a tool or not for user's question, you must:
 
             yield response
 
+    @staticmethod
+    def _hold_back_text(text_parts: list[str], chunk_message: str) -> str | None:
+        """Hold back text tokens to send STREAM_COALESCE_CHUNKS of them together.
+
+        Returns the text to send now, or None if the token is held back.
+        """
+        if STREAM_COALESCE_CHUNKS == 1:
+            return chunk_message
+        text_parts.append(chunk_message)
+        if len(text_parts) < STREAM_COALESCE_CHUNKS:
+            return None
+        chunk_message = "".join(text_parts)
+        text_parts.clear()
+        return chunk_message
+
+    def _flush_text(
+        self, chat_request: ChatRequest, message_id: str, text_parts: list[str]
+    ) -> Iterable[dict]:
+        """Send the text tokens still held back by _hold_back_text."""
+        if text_parts:
+            yield self.create_response_stream(
+                model=chat_request.model,
+                message_id=message_id,
+                chunk_message="".join(text_parts),
+            )
+            text_parts.clear()
+
     def _parse_tool_message(self, tool_message: str) -> list[ToolCall]:
-        if DEBUG:
-            logger.info("Tool message: " + tool_message.replace("\n", " "))
+        logger.debug("Tool message: %s", tool_message)
         try:
-            tool_messages = tool_message[
-                tool_message.rindex("<function>") + len("<function>") :
-            ]
-            function = json.loads(tool_messages.replace("\n", " "))
+            _, tag, tool_messages = tool_message.rpartition("<function>")
+            if not tag:
+                raise ValueError("<function> tag not found")
+            try:
+                function = json.loads(tool_messages)
+            except json.JSONDecodeError:
+                # Raw line breaks are not allowed within JSON strings.
+                function = json.loads(tool_messages.replace("\n", " "))
             args = json.dumps(function.get("arguments", {}))
             function = ResponseFunction(name=function["name"], arguments=args)
 
@@ -541,16 +651,43 @@ Please think if you need to use a tool or not for user's question, you must:
 
         returns a tuple of (Image Data, Content Type)
         """
-        pattern = r"^data:(image/[a-z]*);base64,\s*"
-        content_type = re.search(pattern, image_url)
+        content_type = DATA_URL_PATTERN.match(image_url)
         # if already base64 encoded.
         # Only supports 'image/jpeg', 'image/png', 'image/gif' or 'image/webp'
         if content_type:
-            image_data = re.sub(pattern, "", image_url)
+            image_data = image_url[content_type.end():]
             return image_data, content_type.group(1)
 
+        now = time.monotonic()
+        with image_cache_lock:
+            cached = image_cache.get(image_url)
+            if cached and cached[0] > now:
+                image_cache.move_to_end(image_url)
+                return cached[1], cached[2]
+        image_data, content_type = self._download_image(image_url)
+        if len(image_data) <= IMAGE_CACHE_MAX_IMAGE_SIZE:
+            with image_cache_lock:
+                image_cache[image_url] = (
+                    now + IMAGE_CACHE_TTL,
+                    image_data,
+                    content_type,
+                )
+                image_cache.move_to_end(image_url)
+                while len(image_cache) > IMAGE_CACHE_MAX_IMAGES:
+                    image_cache.popitem(last=False)
+        return image_data, content_type
+
+    @staticmethod
+    def _download_image(image_url: str) -> tuple[str, str]:
+        """Download an image and encode it as base64."""
         # Send a request to the image URL
-        response = requests.get(image_url)
+        try:
+            response = http_session.get(image_url, timeout=10)
+        except requests.RequestException as e:
+            logger.error("Failed to download image: " + str(e))
+            raise HTTPException(
+                status_code=500, detail="Unable to access the image url"
+            )
         # Check if the request was successful
         if response.status_code == 200:
 
@@ -560,8 +697,7 @@ Please think if you need to use a tool or not for user's question, you must:
             # Get the image content
             image_content = response.content
             # Encode the image content as base64
-            base64_image = base64.b64encode(image_content)
-            return base64_image.decode("utf-8"), content_type
+            return pybase64.b64encode_as_string(image_content), content_type
         else:
             raise HTTPException(
                 status_code=500, detail="Unable to access the image url"
@@ -603,7 +739,7 @@ class CustomImportModel(BedrockModel):
         prompt_lines.append("<|assistant|>")
         return "".join(prompt_lines)
 
-    def compose_request_body(self, chat_request: ChatRequest) -> str:
+    def compose_request_body(self, chat_request: ChatRequest) -> bytes:
         prompt = self.create_prompt(chat_request)
         args = {
             "prompt": prompt,
@@ -613,7 +749,7 @@ class CustomImportModel(BedrockModel):
             "top_k": 200,  # Default value
             "stop": [],  # Default value
         }
-        return json.dumps(args)
+        return orjson.dumps(args)
 
     def get_finish_reason(self, response: Dict[str, Any]) -> str:
         """Get the finish reason from the response."""
@@ -652,10 +788,10 @@ class LlamaModel(BedrockModel):
 
         {{ user_message_2 }}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
         """
-        if DEBUG:
-            logger.info("Convert below messages to prompt for Llama 3: ")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Convert below messages to prompt for Llama 3: ")
             for msg in chat_request.messages:
-                logger.info(msg.model_dump_json())
+                logger.debug(msg.model_dump_json())
         bos_token = "<|begin_of_text|>"
 
         prompt_lines = []
@@ -665,8 +801,7 @@ class LlamaModel(BedrockModel):
             )
         prompt_lines.append(f"<|start_header_id|>assistant<|end_header_id|>\n\n")
         prompt = bos_token + "".join(prompt_lines)
-        if DEBUG:
-            logger.info("Converted prompt: " + prompt.replace("\n", "\\n"))
+        logger.debug("Converted prompt: %s", LazyEscapedText(prompt))
         return prompt
 
     @staticmethod
@@ -676,18 +811,18 @@ class LlamaModel(BedrockModel):
         <s>[INST] <<SYS>>\n{your_system_message}\n<</SYS>>\n\n{user_message_1} [/INST] {model_reply_1}</s>
         <s>[INST] {user_message_2} [/INST]
         """
-        if DEBUG:
-            logger.info("Convert below messages to prompt for Llama 2: ")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Convert below messages to prompt for Llama 2: ")
             for msg in chat_request.messages:
-                logger.info(msg.model_dump_json())
+                logger.debug(msg.model_dump_json())
         bos_token = "<s>"
         eos_token = "</s>"
-        prompt = ""
+        prompt_parts = []
         end_turn = False
-        system_prompt = ""
+        system_parts = []
         for msg in chat_request.messages:
             if msg.role == "system":
-                system_prompt += "\n" + msg.content + "\n"
+                system_parts.append("\n" + msg.content + "\n")
                 continue
             if msg.role == "tool":
                 raise HTTPException(
@@ -700,32 +835,39 @@ class LlamaModel(BedrockModel):
                 )
             if msg.role == "user":
                 if end_turn:
-                    prompt += bos_token + "[INST] "
-                prompt += msg.content + " [/INST] "
+                    prompt_parts.append(bos_token + "[INST] ")
+                prompt_parts.append(msg.content + " [/INST] ")
                 end_turn = False
             else:
-                prompt += msg.content + eos_token
+                prompt_parts.append(msg.content + eos_token)
                 end_turn = True
 
+        system_prompt = "".join(system_parts)
         if system_prompt:
             system_prompt = "<<SYS>>" + system_prompt + "<</SYS>>"
-        prompt = bos_token + "[INST] " + system_prompt + prompt
-        if DEBUG:
-            logger.info("Converted prompt: " + prompt.replace("\n", "\\n"))
+        prompt = bos_token + "[INST] " + system_prompt + "".join(prompt_parts)
+        logger.debug("Converted prompt: %s", LazyEscapedText(prompt))
         return prompt
 
-    def compose_request_body(self, chat_request: ChatRequest) -> str:
-        if chat_request.model.startswith("meta.llama2"):
-            prompt = self.create_llama2_prompt(chat_request)
-        else:
-            prompt = self.create_llama3_prompt(chat_request)
+    def compose_request_body(self, chat_request: ChatRequest) -> bytes:
+        # The model family is the model id up to its first "-", e.g. "meta.llama2"
+        family = chat_request.model.split("-", 1)[0]
+        create_prompt = LLAMA_PROMPT_BUILDERS.get(family, self.create_llama3_prompt)
+        prompt = create_prompt(chat_request)
         args = {
             "prompt": prompt,
             "max_gen_len": chat_request.max_tokens,
             "temperature": chat_request.temperature,
             "top_p": chat_request.top_p,
         }
-        return json.dumps(args)
+        return orjson.dumps(args)
+
+
+# Prompt builder of each Llama model family, newer models default to Llama 3.
+LLAMA_PROMPT_BUILDERS = {
+    "meta.llama2": LlamaModel.create_llama2_prompt,
+    "meta.llama3": LlamaModel.create_llama3_prompt,
+}
 
 
 class MistralModel(BedrockModel):
@@ -739,18 +881,18 @@ class MistralModel(BedrockModel):
         <s>[INST] {user_message_2} [/INST]
         """
         # TODO: maybe reuse the Llama 2 one.
-        if DEBUG:
-            logger.info("Convert below messages to prompt for Mistral/Mixtral model: ")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Convert below messages to prompt for Mistral/Mixtral model: ")
             for msg in chat_request.messages:
-                logger.info(msg.model_dump_json())
+                logger.debug(msg.model_dump_json())
         bos_token = "<s>"
         eos_token = "</s>"
-        prompt = ""
+        prompt_parts = []
         end_turn = False
-        system_prompt = ""
+        system_parts = []
         for msg in chat_request.messages:
             if msg.role == "system":
-                system_prompt += "\n" + msg.content + "\n"
+                system_parts.append("\n" + msg.content + "\n")
                 continue
             if msg.role == "tool":
                 raise HTTPException(
@@ -764,19 +906,18 @@ class MistralModel(BedrockModel):
                 )
             if msg.role == "user":
                 if end_turn:
-                    prompt += bos_token + "[INST] "
-                prompt += msg.content + " [/INST] "
+                    prompt_parts.append(bos_token + "[INST] ")
+                prompt_parts.append(msg.content + " [/INST] ")
                 end_turn = False
             else:
-                prompt += msg.content + eos_token
+                prompt_parts.append(msg.content + eos_token)
                 end_turn = True
 
-        prompt = bos_token + "[INST] " + system_prompt + prompt
-        if DEBUG:
-            logger.info("Converted prompt: " + prompt.replace("\n", "\\n"))
+        prompt = bos_token + "[INST] " + "".join(system_parts) + "".join(prompt_parts)
+        logger.debug("Converted prompt: %s", LazyEscapedText(prompt))
         return prompt
 
-    def compose_request_body(self, chat_request: ChatRequest) -> str:
+    def compose_request_body(self, chat_request: ChatRequest) -> bytes:
         prompt = self._convert_prompt(chat_request)
         args = {
             "prompt": prompt,
@@ -784,7 +925,7 @@ class MistralModel(BedrockModel):
             "temperature": chat_request.temperature,
             "top_p": chat_request.top_p,
         }
-        return json.dumps(args)
+        return orjson.dumps(args)
 
     def get_message_text(self, response_body: dict) -> str | None:
         return super().get_message_text(response_body["outputs"][0])
@@ -798,18 +939,21 @@ class MistralModel(BedrockModel):
 
 
 class CohereCommandModel(BedrockModel):
+    # Cohere role of each supported message role
+    role_map = {"user": "USER", "assistant": "CHATBOT"}
 
     def _parse_message(self, message) -> dict:
-        if message.role not in ["user", "assistant"]:
+        role = self.role_map.get(message.role)
+        if role is None:
             raise HTTPException(
                 status_code=400, detail="Only user or assistant message is supported"
             )
         return {
-            "role": "USER" if message.role == "user" else "CHATBOT",
+            "role": role,
             "message": message.content,
         }
 
-    def compose_request_body(self, chat_request: ChatRequest) -> str:
+    def compose_request_body(self, chat_request: ChatRequest) -> bytes:
         messages = chat_request.messages
         if messages[-1].role != "user":
             raise HTTPException(
@@ -823,24 +967,20 @@ class CohereCommandModel(BedrockModel):
             "temperature": chat_request.temperature,
             "p": chat_request.top_p,
         }
-        return json.dumps(args)
+        return orjson.dumps(args)
 
 
 class BedrockEmbeddingsModel(BaseEmbeddingsModel, ABC):
-    accept = "application/json"
-    content_type = "application/json"
-
     def _invoke_model(self, args: dict, model_id: str):
-        body = json.dumps(args)
-        if DEBUG:
-            logger.info("Invoke Bedrock Model: " + model_id)
-            logger.info("Bedrock request body: " + body)
+        body = orjson.dumps(args)
+        logger.debug("Invoke Bedrock Model: %s", model_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Bedrock request body: %s", body.decode())
         try:
             return bedrock_runtime.invoke_model(
                 body=body,
                 modelId=model_id,
-                accept=self.accept,
-                contentType=self.content_type,
+                **INVOKE_MODEL_CONTENT_TYPES,
             )
         except bedrock_runtime.exceptions.ValidationException as e:
             logger.error("Validation Error: " + str(e))
@@ -851,22 +991,36 @@ class BedrockEmbeddingsModel(BaseEmbeddingsModel, ABC):
 
     def _create_response(
         self,
-        embeddings: list[float],
+        embeddings: list[list[float]],
         model: str,
         input_tokens: int = 0,
         output_tokens: int = 0,
         encoding_format: Literal["float", "base64"] = "float",
     ) -> EmbeddingsResponse:
+        # The embeddings come from Bedrock, skip validating every value of each vector.
         data = []
-        for i, embedding in enumerate(embeddings):
-            if encoding_format == "base64":
-                arr = np.array(embedding, dtype=np.float32)
-                arr_bytes = arr.tobytes()
-                encoded_embedding = base64.b64encode(arr_bytes)
-                data.append(Embedding(index=i, embedding=encoded_embedding))
+        if encoding_format == "base64":
+            # Convert all embeddings at once into a single contiguous float32 array.
+            arr = np.ascontiguousarray(embeddings, dtype=np.float32)
+            # Encode straight from the array buffer without copying it to bytes first.
+            if arr.ndim == 2 and arr.shape[1] * arr.itemsize % 3 == 0:
+                # Rows that are a multiple of 3 bytes need no padding, so the base64 of
+                # the whole array splits into the base64 of each row at fixed offsets.
+                encoded = pybase64.b64encode(memoryview(arr).cast("B"))
+                row_chars = arr.shape[1] * arr.itemsize // 3 * 4
+                encoded_embeddings = [
+                    encoded[i * row_chars : (i + 1) * row_chars] for i in range(len(arr))
+                ]
             else:
-                data.append(Embedding(index=i, embedding=embedding))
-        response = EmbeddingsResponse(
+                encoded_embeddings = [
+                    pybase64.b64encode(memoryview(row).cast("B")) for row in arr
+                ]
+            for i, encoded_embedding in enumerate(encoded_embeddings):
+                data.append(Embedding.model_construct(index=i, embedding=encoded_embedding))
+        else:
+            for i, embedding in enumerate(embeddings):
+                data.append(Embedding.model_construct(index=i, embedding=embedding))
+        response = EmbeddingsResponse.model_construct(
             data=data,
             model=model,
             usage=EmbeddingsUsage(
@@ -874,8 +1028,9 @@ class BedrockEmbeddingsModel(BaseEmbeddingsModel, ABC):
                 total_tokens=input_tokens + output_tokens,
             ),
         )
-        if DEBUG:
-            logger.info("Proxy response :" + response.model_dump_json())
+        if logger.isEnabledFor(logging.DEBUG):
+            # Leave out the embeddings, dumping every vector is too costly for a log.
+            logger.debug("Proxy response: %s", response.model_dump_json(exclude={"data"}))
         return response
 
 
@@ -890,6 +1045,7 @@ class CohereEmbeddingsModel(BedrockEmbeddingsModel):
         elif isinstance(embeddings_request.input, Iterable):
             # For encoded input
             # The workaround is to use tiktoken to decode to get the original text.
+            encoder = get_encoder()
             encodings = []
             for inner in embeddings_request.input:
                 if isinstance(inner, int):
@@ -897,10 +1053,10 @@ class CohereEmbeddingsModel(BedrockEmbeddingsModel):
                     encodings.append(inner)
                 else:
                     # Iterable[Iterable[int]]
-                    text = ENCODER.decode(list(inner))
+                    text = encoder.decode(list(inner))
                     texts.append(text)
             if encodings:
-                texts.append(ENCODER.decode(encodings))
+                texts.append(encoder.decode(encodings))
 
         # Maximum of 2048 characters
         args = {
@@ -914,9 +1070,9 @@ class CohereEmbeddingsModel(BedrockEmbeddingsModel):
         response = self._invoke_model(
             args=self._parse_args(embeddings_request), model_id=embeddings_request.model
         )
-        response_body = json.loads(response.get("body").read())
-        if DEBUG:
-            logger.info("Bedrock response body: " + str(response_body))
+        response_body = orjson.loads(response["body"].read())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Bedrock response body: %s", str(response_body)[:2048])
 
         return self._create_response(
             embeddings=response_body["embeddings"],
@@ -955,9 +1111,9 @@ class TitanEmbeddingsModel(BedrockEmbeddingsModel):
         response = self._invoke_model(
             args=self._parse_args(embeddings_request), model_id=embeddings_request.model
         )
-        response_body = json.loads(response.get("body").read())
-        if DEBUG:
-            logger.info("Bedrock response body: " + str(response_body))
+        response_body = orjson.loads(response["body"].read())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Bedrock response body: %s", str(response_body)[:2048])
 
         return self._create_response(
             embeddings=[response_body["embedding"]],
@@ -966,34 +1122,49 @@ class TitanEmbeddingsModel(BedrockEmbeddingsModel):
         )
 
 
+# The models hold no per-request state, so a single instance of each is shared.
+claude_model = ClaudeModel()
+llama_model = LlamaModel()
+mistral_model = MistralModel()
+cohere_command_model = CohereCommandModel()
+custom_import_model = CustomImportModel()
+cohere_embeddings_model = CohereEmbeddingsModel()
+
+# Model of each model id prefix, checked in order.
+MODEL_PREFIXES = (
+    ("anthropic.claude", claude_model),
+    ("meta.llama", llama_model),
+    ("mistral.mistral", mistral_model),
+    ("mistral.mixtral", mistral_model),
+    ("cohere.command-r", cohere_command_model),
+)
+
+
 def get_model(model_id: str) -> BedrockModel:
-    if DEBUG:
-        logger.info("model id is " + model_id)
+    logger.debug("model id is %s", model_id)
     if "imported-model" in model_id:
-        return CustomImportModel()
-    if model_id.startswith("anthropic.claude"):
-        return ClaudeModel()
-    elif model_id.startswith("meta.llama"):
-        return LlamaModel()
-    elif model_id.startswith("mistral.mistral") or model_id.startswith(
-        "mistral.mixtral"
-    ):
-        return MistralModel()
-    elif model_id.startswith("cohere.command-r"):
-        return CohereCommandModel()
-    return CustomImportModel()
+        return custom_import_model
+    for prefix, model in MODEL_PREFIXES:
+        if model_id.startswith(prefix):
+            return model
+    return custom_import_model
+
+
+# Model of each supported embedding model id.
+EMBEDDINGS_MODELS = {
+    model_id: cohere_embeddings_model
+    for model_id, model_name in SUPPORTED_BEDROCK_EMBEDDING_MODELS.items()
+    if model_name in ("Cohere Embed Multilingual", "Cohere Embed English")
+}
 
 
 def get_embeddings_model(model_id: str) -> BedrockEmbeddingsModel:
-    model_name = SUPPORTED_BEDROCK_EMBEDDING_MODELS.get(model_id, "")
-    if DEBUG:
-        logger.info("model name is " + model_name)
-    match model_name:
-        case "Cohere Embed Multilingual" | "Cohere Embed English":
-            return CohereEmbeddingsModel()
-        case _:
-            logger.error("Unsupported model id " + model_id)
-            raise HTTPException(
-                status_code=400,
-                detail="Unsupported embedding model id " + model_id,
-            )
+    logger.debug("model id is %s", model_id)
+    try:
+        return EMBEDDINGS_MODELS[model_id]
+    except KeyError:
+        logger.error("Unsupported model id " + model_id)
+        raise HTTPException(
+            status_code=400,
+            detail="Unsupported embedding model id " + model_id,
+        )
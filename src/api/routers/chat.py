@@ -1,6 +1,7 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Body
+from fastapi import APIRouter, Depends, Body, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 
 from api.auth import api_key_auth
@@ -41,4 +42,8 @@ async def chat_completions(
         return StreamingResponse(
             content=model.chat_stream(chat_request), media_type="text/event-stream"
         )
-    return model.chat(chat_request)
+    response = await run_in_threadpool(model.chat, chat_request)
+    # Serialize directly, FastAPI would otherwise validate and encode the response again.
+    return Response(
+        content=response.model_dump_json(exclude_none=True), media_type="application/json"
+    )
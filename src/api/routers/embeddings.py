@@ -1,6 +1,7 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Body
+from fastapi import APIRouter, Depends, Body, Response
+from fastapi.concurrency import run_in_threadpool
 
 from api.auth import api_key_auth
 from api.models import get_embeddings_model
@@ -33,4 +34,6 @@ async def embeddings(
         embeddings_request.model = DEFAULT_EMBEDDING_MODEL
     # Exception will be raised if model not supported.
     model = get_embeddings_model(embeddings_request.model)
-    return model.embed(embeddings_request)
+    response = await run_in_threadpool(model.embed, embeddings_request)
+    # Serialize directly, FastAPI would otherwise validate and encode every embedding again.
+    return Response(content=response.model_dump_json(), media_type="application/json")
@@ -12,16 +12,19 @@ router = APIRouter(
     # responses={404: {"description": "Not found"}},
 )
 
+# Computed once instead of merging both model dicts on every request.
+SUPPORTED_MODEL_IDS = tuple(SUPPORTED_BEDROCK_MODELS) + tuple(SUPPORTED_BEDROCK_EMBEDDING_MODELS)
+SUPPORTED_MODEL_ID_SET = frozenset(SUPPORTED_MODEL_IDS)
+
 
 async def validate_model_id(model_id: str):
-    if model_id not in (SUPPORTED_BEDROCK_MODELS | SUPPORTED_BEDROCK_EMBEDDING_MODELS).keys() and "imported-model" not in model_id:
+    if model_id not in SUPPORTED_MODEL_ID_SET and "imported-model" not in model_id:
         raise HTTPException(status_code=500, detail="Unsupported Model Id")
 
 
 @router.get("", response_model=Models)
 async def list_models():
-    model_list = [Model(id=model_id) for model_id in
-                  (SUPPORTED_BEDROCK_MODELS | SUPPORTED_BEDROCK_EMBEDDING_MODELS).keys()]
+    model_list = [Model(id=model_id) for model_id in SUPPORTED_MODEL_IDS]
     return Models(data=model_list)
 
 
@@ -141,6 +141,8 @@ class ChatResponse(BaseChatResponse):
 
 
 class ChatStreamResponse(BaseChatResponse):
+    # Stream chunks are built as plain dicts by BedrockModel.create_response_stream
+    # to skip pydantic on every token, keep both in sync.
     choices: list[ChoiceDelta]
     object: Literal["chat.completion.chunk"] = "chat.completion.chunk"
     usage: Usage | None = None
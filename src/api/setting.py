@@ -42,3 +42,8 @@ DEFAULT_MODEL = os.environ.get(
 DEFAULT_EMBEDDING_MODEL = os.environ.get(
     "DEFAULT_EMBEDDING_MODEL", "cohere.embed-multilingual-v3"
 )
+# Number of streamed text tokens to send per chunk, 1 sends every token as it arrives.
+try:
+    STREAM_COALESCE_CHUNKS = max(int(os.environ.get("STREAM_COALESCE_CHUNKS", "1")), 1)
+except ValueError:
+    STREAM_COALESCE_CHUNKS = 1